@@ -1,241 +1,392 @@
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, Response, request, jsonify, render_template, send_file
 import pandas as pd
+import numpy as np
+import xgboost as xgb
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
 import joblib
-import shap
 import os
-import matplotlib.pyplot as plt
-import uuid
+import logging
+import json
+import asyncio
+import csv
+import hashlib
+import time
+import queue
+import threading
+from io import BytesIO, StringIO
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from fpdf import FPDF
+from model_utils import trim_to_best_iteration
 
 app = Flask(__name__)
+app.logger.setLevel(logging.INFO)
+
+MODEL_PICKLE = "best_xgb_models.pkl"
+
+def is_current(path):
+    # Files exported before the pickle last changed were built from an older model
+    if not os.path.exists(path):
+        return False
+    return not os.path.exists(MODEL_PICKLE) or os.path.getmtime(path) >= os.path.getmtime(MODEL_PICKLE)
 
 # Load models and expected features
-models = joblib.load("best_xgb_models.pkl")
+# Prefer native boosters exported by export_models.py over the pickled classifiers
+MODEL_DIR = "models"
+MODEL_INDEX = os.path.join(MODEL_DIR, "antibiotics.json")
+if is_current(MODEL_INDEX):
+    with open(MODEL_INDEX) as f:
+        boosters = {abx: xgb.Booster(model_file=os.path.join(MODEL_DIR, f"{abx}.ubj")) for abx in json.load(f)}
+    app.logger.info("Loaded models from %s/", MODEL_DIR)
+else:
+    if os.path.exists(MODEL_INDEX):
+        app.logger.warning("%s/ is older than %s; rerun export_models.py", MODEL_DIR, MODEL_PICKLE)
+    boosters = {abx: m.get_booster() for abx, m in joblib.load(MODEL_PICKLE).items()}
+    app.logger.info("Loaded models from %s", MODEL_PICKLE)
+boosters = {abx: trim_to_best_iteration(b) for abx, b in boosters.items()}
 expected_features = joblib.load("xgb_expected_features.pkl")
+feature_names = np.asarray(expected_features)
+expected_set = set(expected_features)
 
-# Ensure static folder exists
-os.makedirs("static", exist_ok=True)
-
-UPLOAD_HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <title>UTI Antibiotic Resistance Predictor</title>
-  <style>
-    body {
-      font-family: Arial, sans-serif;
-      background-color: #f4f6f9;
-      padding: 40px;
-      display: flex;
-      justify-content: center;
-    }
-    .card {
-      background-color: white;
-      border-radius: 12px;
-      box-shadow: 0 4px 12px rgba(0,0,0,0.1);
-      padding: 30px;
-      max-width: 700px;
-      width: 100%;
-    }
-    h1 {
-      text-align: center;
-      color: #111;
-    }
-    .predict-button {
-      background-color: #007bff;
-      color: white;
-      border: none;
-      padding: 10px 16px;
-      font-size: 16px;
-      border-radius: 6px;
-      cursor: pointer;
-    }
-    .result-row {
-      display: flex;
-      flex-wrap: wrap;
-      justify-content: space-between;
-      margin-top: 20px;
-    }
-    .pill {
-      flex: 0 0 48%;
-      margin-bottom: 15px;
-      padding: 12px;
-      color: white;
-      font-weight: bold;
-      border-radius: 20px;
-      text-align: center;
-    }
-    .resistant {
-      background-color: #e74c3c;
-    }
-    .susceptible {
-      background-color: #2ecc71;
-    }
-    .section {
-      margin-top: 30px;
-    }
-    .shap-img {
-      max-width: 100%;
-      margin-top: 10px;
-    }
-    .btn-group {
-      margin-top: 20px;
-      display: flex;
-      gap: 20px;
-    }
-    .btn-group a {
-      background: #007bff;
-      color: white;
-      padding: 8px 14px;
-      border-radius: 6px;
-      text-decoration: none;
+# Single-row requests: skip the OpenMP fork-join on every prediction
+for booster in boosters.values():
+    booster.set_param({"device": "cpu", "nthread": 1})
+
+# Accelerated predictors from export_models.py, when built.
+# PREDICTOR_BACKEND picks "tl2cgen" (compiled trees), "onnx" or "xgboost".
+PREDICTOR_BACKEND = os.environ.get("PREDICTOR_BACKEND", "tl2cgen")
+PREDICTOR_DIR = "predictors"
+ONNX_DIR = "onnx"
+
+def backend_files_current(directory, ext):
+    return all(is_current(os.path.join(directory, f"{abx}{ext}")) for abx in boosters)
+
+predictors = {}
+onnx_sessions = {}
+if PREDICTOR_BACKEND == "tl2cgen" and backend_files_current(PREDICTOR_DIR, ".so"):
+    import tl2cgen
+    predictors = {abx: tl2cgen.Predictor(os.path.join(PREDICTOR_DIR, f"{abx}.so"), nthread=1) for abx in boosters}
+elif PREDICTOR_BACKEND == "onnx" and backend_files_current(ONNX_DIR, ".onnx"):
+    import onnxruntime as ort
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = 1
+    onnx_sessions = {
+        abx: ort.InferenceSession(os.path.join(ONNX_DIR, f"{abx}.onnx"), sess_options, providers=["CPUExecutionProvider"])
+        for abx in boosters
     }
-  </style>
-</head>
-<body>
-  <div class="card">
-    <h1>UTI Antimicrobial Resistance Predictor</h1>
-    <form id="upload-form">
-      <input type="file" id="csv-file" name="file" accept=".csv" required>
-      <button type="submit" class="predict-button">Predict</button>
-    </form>
-    <div id="results" class="section"></div>
-  </div>
-
-  <script>
-    document.getElementById("upload-form").addEventListener("submit", async function(event) {
-      event.preventDefault();
-      const file = document.getElementById("csv-file").files[0];
-      if (!file) return;
-
-      const formData = new FormData();
-      formData.append("file", file);
-
-      const response = await fetch("/upload", {
-        method: "POST",
-        body: formData
-      });
-
-      const html = await response.text();
-      document.getElementById("results").innerHTML = response.ok ? html : `<pre>${html}</pre>`;
-    });
-  </script>
-</body>
-</html>
-"""
+app.logger.info("Prediction backend: %s", "tl2cgen" if predictors else "onnx" if onnx_sessions else "xgboost")
+
+def predict_proba(abx, X):
+    if abx in predictors:
+        return predictors[abx].predict(tl2cgen.DMatrix(X)).reshape(len(X))
+    if abx in onnx_sessions:
+        # Outputs are (label, probabilities)
+        return onnx_sessions[abx].run(None, {"input": X})[1][:, 1]
+    return boosters[abx].inplace_predict(X)
+
+# shap is only imported once an antibiotic is predicted resistant
+@lru_cache(maxsize=None)
+def get_explainer(abx):
+    import shap
+    return shap.TreeExplainer(boosters[abx], feature_perturbation="tree_path_dependent", model_output="raw")
+
+@lru_cache(maxsize=512)
+def cached_shap(abx, row_bytes):
+    row = np.frombuffer(row_bytes, dtype=np.float32).reshape(1, -1)
+    vals = get_explainer(abx).shap_values(row)[0]
+    k = min(5, len(vals))
+    idx = np.argpartition(-np.abs(vals), k - 1)[:k]
+    idx = idx[np.argsort(-np.abs(vals[idx]))]
+    return feature_names[idx], vals[idx]
+
+# Warm up predictors so the first request doesn't pay for it
+X_warm = np.zeros((1, len(expected_features)), dtype=np.float32)
+for abx in boosters:
+    predict_proba(abx, X_warm)
+
+# Rows from concurrent uploads are stacked and scored together
+MAX_BATCH = 64
+MAX_WAIT_MS = 10
+PREDICT_TIMEOUT = 30
+predict_queue = queue.Queue()
+
+def batch_worker():
+    while True:
+        batch = [predict_queue.get()]
+        try:
+            deadline = time.monotonic() + MAX_WAIT_MS / 1000
+            while len(batch) < MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(predict_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Skip callers that timed out or went away before their row was scored
+            batch = [(X, future) for X, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            X_batch = np.vstack([X for X, _ in batch])
+            batch_probs = np.column_stack([predict_proba(abx, X_batch) for abx in boosters])
+            for (_, future), probs in zip(batch, batch_probs):
+                future.set_result(probs)
+        except Exception as e:
+            # Never let one bad batch kill the worker; fail its callers instead
+            app.logger.exception("Prediction batch failed")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+threading.Thread(target=batch_worker, daemon=True).start()
+
+def shap_bar_svg(top_features, top_shap, title):
+    scale = 200 / max(np.abs(top_shap).max(), 1e-12)
+    bars = []
+    for i, (feature, value) in enumerate(zip(top_features, top_shap)):
+        y = 30 + i * 24
+        color = "#e74c3c" if value > 0 else "#27ae60"
+        bars.append(f"""
+            <text x="0" y="{y + 12}" font-size="12">{feature}</text>
+            <rect x="300" y="{y}" width="{abs(value) * scale:.1f}" height="16" fill="{color}"/>
+        """)
+    return f"""
+        <svg class='shap-img' width="520" height="{30 + len(bars) * 24}" xmlns="http://www.w3.org/2000/svg">
+            <text x="0" y="16" font-size="14" font-weight="bold">{title}</text>
+            {''.join(bars)}
+        </svg>
+    """
+
+def build_pdf(rows):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    pdf.cell(200, 10, text="UTI Antimicrobial Resistance Report", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.ln(10)
+    pdf.multi_cell(0, 10, text="\n".join(f"{abx}: {label} ({prob})" for abx, label, prob in rows))
+    return bytes(pdf.output())
+
+# PDF reports are a few lines, so a small thread pool is enough to keep them off
+# the request thread without forking this multi-threaded process
+pdf_pool = ThreadPoolExecutor(max_workers=2)
+
+# TreeSHAP releases the GIL, so explanations for each antibiotic run concurrently.
+# Whole explanation blocks are assembled on their own pool so they never wait on
+# a shap_pool slot they are holding.
+shap_pool = ThreadPoolExecutor(max_workers=8)
+explain_pool = ThreadPoolExecutor(max_workers=4)
+
+def build_explanations(resistant, row_bytes):
+    top_shaps = shap_pool.map(lambda abx: cached_shap(abx, row_bytes), resistant)
+    explanations = []
+    for abx, (top_features, top_shap) in zip(resistant, top_shaps):
+        explanations.append(f"""
+            <div class='section'>
+                <h4>{abx} - Top 5 Contributing Features</h4>
+                <ol>
+                    {''.join(f"<li>{feature} (Impact: {value:.4f})</li>" for feature, value in zip(top_features, top_shap))}
+                </ol>
+                {shap_bar_svg(top_features, top_shap, f"Top 5 Features for {abx} Resistance")}
+            </div>
+        """)
+    return "".join(explanations).encode()
+
+# Report files for the most recent uploads are kept in memory, never on disk.
+# Each entry maps artifact name to bytes, or to a Future while it is being built.
+# The store is private to this process, so the app must be served by a single
+# process (see the dockerfile); scale with threads, not workers.
+MAX_ARTIFACT_REQUESTS = 256
+ARTIFACTS = OrderedDict()
+artifacts_lock = threading.Lock()
+
+# Only the report files are downloadable; other artifacts are internal
+DOWNLOADABLE_ARTIFACTS = {"report.csv", "report.pdf"}
+
+def store_artifacts(uid, artifacts):
+    with artifacts_lock:
+        ARTIFACTS[uid] = artifacts
+        while len(ARTIFACTS) > MAX_ARTIFACT_REQUESTS:
+            ARTIFACTS.popitem(last=False)
+
+def get_artifact(uid, name):
+    with artifacts_lock:
+        blob = ARTIFACTS.get(uid, {}).get(name)
+        if blob is not None:
+            ARTIFACTS.move_to_end(uid)
+    return blob
+
+def discard_artifact(uid, name):
+    with artifacts_lock:
+        ARTIFACTS.get(uid, {}).pop(name, None)
+
+# The upload page has no template variables, so it is rendered once at import
+with app.app_context():
+    INDEX_HTML = render_template("index.html")
+INDEX_ETAG = hashlib.md5(INDEX_HTML.encode()).hexdigest()
 
 @app.route("/", methods=["GET"])
 def index():
-    return render_template_string(UPLOAD_HTML)
+    resp = Response(INDEX_HTML, mimetype="text/html")
+    resp.set_etag(INDEX_ETAG)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 3600
+    return resp.make_conditional(request)
 
 @app.route("/upload", methods=["POST"])
-def upload_csv():
+async def upload_csv():
     try:
         if "file" not in request.files:
             return jsonify({"error": "No file uploaded"}), 400
 
-        file = request.files["file"]
-        df = pd.read_csv(file)
-        df.columns = df.columns.str.strip()
-
-        # Keep only expected features
-        df = df[[col for col in df.columns if col in expected_features]]
-        df = df[expected_features]
-
-        predictions = {}
-        probabilities = {}
-        explanations = []
-        csv_rows = []
-
-        uid = str(uuid.uuid4())[:8]
-
-        for abx, model in models.items():
-            pred = int(model.predict(df)[0])
-            prob = float(model.predict_proba(df)[0][1])
-            predictions[abx] = pred
-            probabilities[abx] = prob
-
-            csv_rows.append([abx, "Resistant" if pred else "Susceptible", f"{prob*100:.2f}%"])
-
-            if pred == 1:
-                explainer = shap.Explainer(model)
-                shap_vals = explainer(df)
-                top_df = pd.DataFrame({
-                    "feature": df.columns,
-                    "shap": shap_vals.values[0]
-                }).sort_values(by="shap", key=abs, ascending=False).head(5)
-
-                # Plotting
-                plt.figure(figsize=(6, 3))
-                plt.barh(top_df["feature"], top_df["shap"], color="skyblue")
-                plt.gca().invert_yaxis()
-                plt.title(f"Top 5 Features for {abx} Resistance")
-                shap_path = f"static/shap_{uid}_{abx}.png"
-                plt.tight_layout()
-                plt.savefig(shap_path)
-                plt.close()
-
-                explanations.append(f"""
-                    <div class='section'>
-                        <h4>{abx} - Top 5 Contributing Features</h4>
-                        <ol>
-                            {''.join(f"<li>{row['feature']} (Impact: {row['shap']:.4f})</li>" for _, row in top_df.iterrows())}
-                        </ol>
-                        <img src='/{shap_path}' class='shap-img'>
-                    </div>
-                """)
+        # Read the upload once; both parsers work on the same in-memory bytes
+        data = request.files["file"].stream.read()
+        stream = BytesIO(data)
+
+        # Only parse the columns the models use, with header names stripped up front
+        header = [col.strip() for col in next(csv.reader([stream.readline().decode("utf-8-sig")]))]
+        stream.seek(0)
+        header_set = set(header)
+        missing = [col for col in expected_features if col not in header_set]
+        if missing:
+            return jsonify({"error": "Missing expected features", "missing": missing}), 400
+        wanted = [col for col in header if col in expected_set]
+        if pacsv is not None:
+            df = pacsv.read_csv(
+                pa.BufferReader(data),
+                read_options=pacsv.ReadOptions(column_names=header, skip_rows=1),
+                convert_options=pacsv.ConvertOptions(include_columns=wanted)
+            ).to_pandas()
+        else:
+            df = pd.read_csv(stream, header=0, names=header, usecols=wanted)
+
+        if df.empty:
+            return jsonify({"error": "No data rows in uploaded CSV"}), 400
+
+        # Order columns as the models expect
+        df = df.reindex(columns=expected_features)
+        # Only the first row is reported, so only the first row is scored
+        X = np.ascontiguousarray(df.iloc[:1].to_numpy(dtype=np.float32))
+        row_bytes = X[0].tobytes()
+
+        # Identical feature rows share one uid, so a repeat upload reuses its artifacts
+        uid = hashlib.sha256(row_bytes).hexdigest()[:16]
+        cached = get_artifact(uid, "result.html")
+        if cached is not None:
+            return Response(cached, mimetype="text/html")
+
+        labels = list(boosters)
+
+        future = Future()
+        predict_queue.put((X, future))
+        try:
+            probs = await asyncio.wait_for(asyncio.wrap_future(future), timeout=PREDICT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return jsonify({"error": "Prediction timed out"}), 503
+        preds = (probs >= 0.5).astype(np.int8)
+        resistant = [abx for abx, pred in zip(labels, preds) if pred == 1]
+
+        rows = list(zip(
+            labels,
+            np.where(preds == 1, "Resistant", "Susceptible").tolist(),
+            np.char.mod("%.2f%%", probs * 100).tolist()
+        ))
 
         # Clinical suggestion
-        tips = ""
-        if any(predictions.values()):
-            tips = "<ul>"
-            for abx in predictions:
-                if predictions[abx] == 1:
-                    tips += f"<li>Avoid prescribing <b>{abx}</b>. Consider alternative therapy.</li>"
-            tips += "</ul>"
+        if resistant:
+            tips = "<ul>" + "".join(
+                f"<li>Avoid prescribing <b>{abx}</b>. Consider alternative therapy.</li>" for abx in resistant
+            ) + "</ul>"
         else:
             tips = "All antibiotics show low resistance risk. Proceed with standard empiric treatment."
 
-        # Save CSV
-        csv_file = f"static/report_{uid}.csv"
-        pd.DataFrame(csv_rows, columns=["Antibiotic", "Prediction", "Probability"]).to_csv(csv_file, index=False)
-
-        # Save PDF
-        pdf_path = f"static/report_{uid}.pdf"
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-        pdf.cell(200, 10, txt="UTI Antimicrobial Resistance Report", ln=True, align='C')
-        pdf.ln(10)
-        for abx, label, prob in csv_rows:
-            pdf.cell(200, 10, txt=f"{abx}: {label} ({prob})", ln=True)
-        pdf.output(pdf_path)
+        # CSV and PDF reports
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["Antibiotic", "Prediction", "Probability"])
+        writer.writerows(rows)
+        artifacts = {
+            "report.csv": buf.getvalue().encode(),
+            "report.pdf": pdf_pool.submit(build_pdf, rows)
+        }
+
+        # SHAP explanations are built in the background; the page polls for them
+        explanations = ""
+        if resistant:
+            artifacts["explanations.html"] = explain_pool.submit(build_explanations, resistant, row_bytes)
+            explanations = f"""
+                <div class='section' data-explanations='/explanations/{uid}'>
+                    <p>Computing feature explanations...</p>
+                </div>
+            """
 
         # Build prediction pills
-        pill_html = ""
-        for abx in predictions:
-            label = "Resistant" if predictions[abx] == 1 else "susceptible"
-            color = "resistant" if predictions[abx] == 1 else "susceptible"
-            percent = f"{probabilities[abx]*100:.0f}%"
-            pill_html += f"<div class='pill {color}'>{abx}&nbsp;&nbsp;{label} ({percent})</div>"
+        pill_parts = []
+        for abx, pred, prob in zip(labels, preds, probs):
+            label = "Resistant" if pred == 1 else "susceptible"
+            color = "resistant" if pred == 1 else "susceptible"
+            percent = f"{prob*100:.0f}%"
+            pill_parts.append(f"<div class='pill {color}'>{abx}&nbsp;&nbsp;{label} ({percent})</div>")
+        pill_html = "".join(pill_parts)
 
         # Assemble final HTML
-        return f"""
+        result_html = f"""
             <div class='result-row'>{pill_html}</div>
             <div class='section'>
                 <h3>Clinical Suggestion</h3>
                 {tips}
             </div>
-            {''.join(explanations)}
+            {explanations}
             <div class='btn-group'>
-                <a href='/{csv_file}' download>Download CSV</a>
-                <a href='/{pdf_path}' download>Download PDF</a>
+                <a href='/artifact/{uid}/report.csv' download>Download CSV</a>
+                <a href='/artifact/{uid}/report.pdf' download>Download PDF</a>
             </div>
         """
+        artifacts["result.html"] = result_html.encode()
+        store_artifacts(uid, artifacts)
+        return result_html
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/explanations/<uid>", methods=["GET"])
+def poll_explanations(uid):
+    job = get_artifact(uid, "explanations.html")
+    if job is None:
+        return jsonify({"error": "Unknown report"}), 404
+    if isinstance(job, Future):
+        if not job.done():
+            return "", 202
+        try:
+            job = job.result()
+        except Exception as e:
+            app.logger.exception("SHAP explanations failed for %s", uid)
+            # Drop the cached result so a resubmission of the same row runs again
+            discard_artifact(uid, "result.html")
+            return jsonify({"error": str(e)}), 500
+    return Response(job, mimetype="text/html")
+
+@app.route("/artifact/<uid>/<name>", methods=["GET"])
+def download_artifact(uid, name):
+    blob = get_artifact(uid, name) if name in DOWNLOADABLE_ARTIFACTS else None
+    if blob is None:
+        return jsonify({"error": "Unknown report"}), 404
+    if isinstance(blob, Future):
+        try:
+            blob = blob.result()
+        except Exception as e:
+            app.logger.exception("Building %s failed for %s", name, uid)
+            # Drop the cached result so a resubmission of the same row runs again
+            discard_artifact(uid, "result.html")
+            return jsonify({"error": str(e)}), 500
+    return send_file(BytesIO(blob), as_attachment=True, download_name=f"{uid}_{name}",
+                     conditional=True, etag=hashlib.sha256(blob).hexdigest())
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host="0.0.0.0", port=5000)
@@ -0,0 +1,67 @@
+import copy
+import json
+import os
+import joblib
+import numpy as np
+import onnxruntime as ort
+import pandas as pd
+import tl2cgen
+import treelite
+import xgboost as xgb
+from onnxmltools.convert import convert_xgboost
+from onnxmltools.convert.common.data_types import FloatTensorType
+from model_utils import trim_to_best_iteration
+
+# One-time export of the pickled XGBClassifiers to native UBJSON boosters,
+# compiled tl2cgen predictors and ONNX models
+MODEL_DIR = "models"
+PREDICTOR_DIR = "predictors"
+ONNX_DIR = "onnx"
+for d in (MODEL_DIR, PREDICTOR_DIR, ONNX_DIR):
+    os.makedirs(d, exist_ok=True)
+
+def check_backend(abx, backend, expected, actual):
+    diff = np.abs(np.asarray(actual, dtype=np.float64) - expected).max()
+    if diff > 1e-4:
+        raise RuntimeError(f"{abx}: {backend} probabilities differ from predict_proba by {diff:.6f}")
+
+models = joblib.load("best_xgb_models.pkl")
+expected_features = joblib.load("xgb_expected_features.pkl")
+n_features = len(expected_features)
+
+# Every exported backend must reproduce predict_proba on the template row
+template = pd.read_csv("xgb_input_template.csv")
+template.columns = template.columns.str.strip()
+template = template[expected_features]
+X_check = np.ascontiguousarray(template.to_numpy(dtype=np.float32))
+
+for abx, model in models.items():
+    expected = model.predict_proba(template)[:, 1]
+    booster = trim_to_best_iteration(model.get_booster())
+
+    ubj_path = os.path.join(MODEL_DIR, f"{abx}.ubj")
+    booster.save_model(ubj_path)
+    check_backend(abx, "xgboost", expected, xgb.Booster(model_file=ubj_path).inplace_predict(X_check))
+
+    # Compile the ensemble to a shared library for faster single-row prediction
+    lib_path = os.path.join(PREDICTOR_DIR, f"{abx}.so")
+    tl2cgen.export_lib(treelite.frontend.from_xgboost(booster), toolchain="gcc",
+                       libpath=lib_path, params={"parallel_comp": 32})
+    predictor = tl2cgen.Predictor(lib_path)
+    check_backend(abx, "tl2cgen", expected, predictor.predict(tl2cgen.DMatrix(X_check)).reshape(len(X_check)))
+
+    # Convert from the trimmed booster; the ONNX converter only understands
+    # XGBoost's default f0, f1, ... feature names
+    onnx_source = copy.deepcopy(model)
+    onnx_source._Booster = booster.copy()
+    onnx_source._Booster.feature_names = None
+    onnx_model = convert_xgboost(onnx_source, initial_types=[("input", FloatTensorType([None, n_features]))])
+    onnx_path = os.path.join(ONNX_DIR, f"{abx}.onnx")
+    with open(onnx_path, "wb") as f:
+        f.write(onnx_model.SerializeToString())
+    session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+    check_backend(abx, "onnx", expected, session.run(None, {"input": X_check})[1][:, 1])
+
+# Keep the antibiotic order used by the app
+with open(os.path.join(MODEL_DIR, "antibiotics.json"), "w") as f:
+    json.dump(list(models), f)
@@ -0,0 +1,7 @@
+# Shared by app.py and export_models.py so exported and runtime models trim alike
+
+def trim_to_best_iteration(booster):
+    # Early-stopped models keep trees past best_iteration, which
+    # XGBClassifier.predict_proba ignores; drop them so every path scores alike
+    best = booster.attr("best_iteration")
+    return booster[: int(best) + 1] if best is not None else booster